@@ -3,11 +3,12 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torchvision import datasets, transforms, models
-from torch.utils.data import DataLoader, SubsetRandomSampler
+from torchvision import io as tv_io
+from torchvision.transforms import v2
+from torch.utils.data import DataLoader, Subset, WeightedRandomSampler
 import numpy as np
 from tqdm import tqdm
 import logging
-import copy
 from torch.optim.lr_scheduler import OneCycleLR
 from torch.utils.tensorboard import SummaryWriter
 from PIL import Image
@@ -15,15 +16,49 @@ from torch.utils.data import Dataset
 from torchvision.datasets import ImageFolder 
 from torchmetrics import Accuracy, MeanMetric
 
+# albumentations (cv2-backed) is ~3-5x faster than stock PIL for these augmentations
+try:
+    import albumentations as A
+    import cv2
+    albumentations_available = True
+except ImportError:
+    albumentations_available = False
+
+# WebDataset turns the 24k random small-file reads on /mnt/gsdata into sequential tar reads
+try:
+    import webdataset as wds
+    webdataset_available = True
+except ImportError:
+    webdataset_available = False
+
+# NVIDIA DALI is only installed on the GPU nodes; fall back to torchvision loaders without it
+try:
+    from nvidia.dali import pipeline_def
+    import nvidia.dali.fn as fn
+    import nvidia.dali.types as types
+    from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+    dali_available = True
+except ImportError:
+    dali_available = False
+
 # Paths and constants
 checkpoint_path = "/mnt/gsdata/projects/bigplantsens/5_ETH_Zurich_Citizen_Science_Segment/Checkpoint"
 data_path = "/mnt/gsdata/projects/bigplantsens/5_ETH_Zurich_Citizen_Science_Segment/data/"
 num_img_per_class = 4000
 batch_size = 16
+accum_steps = 4  # gradient accumulation: effective batch = batch_size * accum_steps
+ema_decay = 0.9999  # EMA of the weights; validation and checkpoints use the averaged weights
 num_epochs = 150
 num_classes = 6
 image_size = 512  # Manually set image size
 GPU_index = 'cuda:2'
+data_backend = 'dali'  # 'dali' / 'gpu-decode' decode+augment on GPU, 'webdataset' reads tar shards, 'pytorch' uses the CPU workers
+
+# Sharded tars for the 'webdataset' backend, produced by script/util/Pack_webdataset_shards.py
+webdataset_train_shards = '/mnt/gsdata/projects/bigplantsens/5_ETH_Zurich_Citizen_Science_Segment/shards/train-{000000..000019}.tar'
+webdataset_val_shards = '/mnt/gsdata/projects/bigplantsens/5_ETH_Zurich_Citizen_Science_Segment/shards/val-{000000..000004}.tar'
+webdataset_train_size = 19200  # sample counts printed by the packing script
+webdataset_val_size = 4800
 
 # Initialize logger
 logging.basicConfig(
@@ -33,103 +68,395 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# CPU workers only do the PIL-level augmentations and hand back uint8 arrays;
+# ToTensor/Normalize/RandomErasing now run on the GPU (fast_collate + CudaPrefetcher),
+# so each 512x512 image crosses the worker IPC boundary at 0.75 MB instead of 3 MB
 transform = transforms.Compose([
     transforms.RandomHorizontalFlip(),
     transforms.RandomVerticalFlip(),
     transforms.ColorJitter(),
     transforms.RandomResizedCrop(image_size),  # Handles both resizing and cropping
-    transforms.ToTensor(),
-    transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-    transforms.RandomErasing(p=0.2, value='random')
+    np.asarray,
     ])
 
+# Deterministic resize + center-crop for validation, matching the DALI/gpu-decode val paths
+val_transform = transforms.Compose([
+    transforms.Resize(image_size),
+    transforms.CenterCrop(image_size),
+    np.asarray,
+    ])
+
+if albumentations_available:
+    albu_transform = A.Compose([
+        A.HorizontalFlip(),
+        A.VerticalFlip(),
+        A.ColorJitter(),
+        A.RandomResizedCrop(size=(image_size, image_size)),
+        ])
+    albu_val_transform = A.Compose([
+        A.SmallestMaxSize(image_size),
+        A.CenterCrop(image_size, image_size),
+        ])
+
+def cv2_loader(path):
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+def apply_albumentations(img):
+    # Output stays uint8 HWC for fast_collate; normalization still happens on the GPU
+    return albu_transform(image=img)['image']
+
+def apply_albumentations_val(img):
+    return albu_val_transform(image=img)['image']
+
+def fast_collate(batch):
+    """Stack uint8 HWC numpy images into a uint8 NCHW tensor without any float conversion."""
+    targets = torch.tensor([b[1] for b in batch], dtype=torch.int64)
+    imgs = torch.empty((len(batch), 3, image_size, image_size), dtype=torch.uint8)
+    for i, (img, _) in enumerate(batch):
+        imgs[i] = torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1)))
+    return imgs, targets
+
+def raw_jpeg_collate(batch):
+    """Keep the encoded JPEG bytes as-is; decoding happens batched on the GPU."""
+    targets = torch.tensor([b[1] for b in batch], dtype=torch.int64)
+    return [b[0] for b in batch], targets
+
+class GpuDecodeLoader:
+    """Decode raw JPEG bytes with one batched nvJPEG call and run the
+    augmentations as CUDA ops; yields normalized float batches on the device."""
+    def __init__(self, loader, device, training):
+        self.loader = loader
+        self.device = device
+        self.training = training
+        if training:
+            self.augment = v2.Compose([
+                v2.RandomHorizontalFlip(),
+                v2.RandomVerticalFlip(),
+                v2.ColorJitter(),
+                v2.RandomResizedCrop(image_size, antialias=True),
+                ])
+        else:
+            self.augment = v2.Compose([
+                v2.Resize(image_size, antialias=True),
+                v2.CenterCrop(image_size),
+                ])
+        self.mean = torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor([0.229, 0.224, 0.225], device=device).view(1, 3, 1, 1) * 255
+        self.erase = transforms.RandomErasing(p=0.2, value='random', inplace=True)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for raw, labels in self.loader:
+            imgs = tv_io.decode_jpeg(raw, device=self.device, mode=tv_io.ImageReadMode.RGB)
+            imgs = torch.stack([self.augment(img) for img in imgs])
+            imgs = imgs.contiguous(memory_format=torch.channels_last).float().sub_(self.mean).div_(self.std)
+            if self.training:
+                for img in imgs:
+                    self.erase(img)
+            yield imgs, labels.to(self.device, non_blocking=True)
+
 device = torch.device(GPU_index if torch.cuda.is_available() else 'cpu')
 torch.cuda.set_device(device)  # Remove the helper function entirely
+torch.set_float32_matmul_precision('high')  # Let remaining FP32 matmuls use TF32 tensor cores
+
+class CustomImageFolder(ImageFolder):
+    """ImageFolder with a single-pass os.scandir directory scan. torchvision's
+    os.walk + per-file validity check issues many extra stat calls, which is
+    slow on the networked /mnt/gsdata tree."""
+    exts = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+    @classmethod
+    def make_dataset(cls, directory, class_to_idx, extensions=None, is_valid_file=None, allow_empty=False):
+        images = []
+        for class_name in sorted(class_to_idx):
+            class_idx = class_to_idx[class_name]
+            class_images = []
+            with os.scandir(os.path.join(directory, class_name)) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False) and entry.name.lower().endswith(cls.exts):
+                        class_images.append((entry.path, class_idx))
+            images.extend(sorted(class_images))  # keep the same deterministic order as os.walk
+        return images
+
+class JpegImageFolder(CustomImageFolder):
+    """nvJPEG can only decode JPEGs; the gpu-decode backend must not pick up other formats."""
+    exts = ('.jpg', '.jpeg')
+
+class DALILoader:
+    """Thin wrapper so a DALI iterator looks like a torch DataLoader to train_model."""
+    def __init__(self, dali_iter, n_samples, batch_size):
+        self.dali_iter = dali_iter
+        self.dataset = range(n_samples)  # for the len(loader.dataset) epoch averages
+        self.n_batches = (n_samples + batch_size - 1) // batch_size
+
+    def __len__(self):
+        return self.n_batches
+
+    def __iter__(self):
+        for batch in self.dali_iter:
+            yield batch[0]['data'], batch[0]['label'].squeeze(-1).long()
+        self.dali_iter.reset()
+
+def get_dali_loaders(data_dir, batch_size, num_img_per_class, image_size):
+
+    dataset = CustomImageFolder(root=data_dir)
+
+    # Split unique indices 80/20 first, then balance the train list only by per-class
+    # oversampling — oversampling before the split would put the same image in both lists
+    labels = np.array([s[1] for s in dataset.samples])
+    indices = np.random.permutation(len(dataset))
+    split = int(0.8 * len(indices))
+    train_indices, val_indices = indices[:split], indices[split:]
+
+    train_labels = labels[train_indices]
+    n_train_per_class = int(0.8 * num_img_per_class)
+    balanced = []
+    for class_idx in range(len(dataset.classes)):
+        class_indices = train_indices[train_labels == class_idx]
+        replace = len(class_indices) < n_train_per_class
+        balanced.extend(np.random.choice(class_indices, n_train_per_class, replace=replace))
+    train_indices = np.random.permutation(balanced)
+
+    # DALI's file reader takes a "path label" list per split
+    os.makedirs(checkpoint_path, exist_ok=True)
+    list_files = []
+    for name, idx in (('train', train_indices), ('val', val_indices)):
+        list_path = os.path.join(checkpoint_path, f'dali_{name}_list.txt')
+        with open(list_path, 'w') as f:
+            for i in idx:
+                path, label = dataset.samples[i]
+                f.write(f'{path} {label}\n')
+        list_files.append(list_path)
+
+    @pipeline_def
+    def image_pipeline(file_list, is_training):
+        jpegs, targets = fn.readers.file(file_list=file_list, random_shuffle=is_training, name="Reader")
+        images = fn.decoders.image(jpegs, device="mixed")  # nvJPEG decode on GPU
+        if is_training:
+            images = fn.random_resized_crop(images, device="gpu", size=image_size)
+            images = fn.flip(images, horizontal=fn.random.coin_flip(), vertical=fn.random.coin_flip())
+            images = fn.color_twist(images,
+                                    brightness=fn.random.uniform(range=[0.8, 1.2]),
+                                    contrast=fn.random.uniform(range=[0.8, 1.2]),
+                                    saturation=fn.random.uniform(range=[0.8, 1.2]))
+        else:
+            images = fn.resize(images, device="gpu", resize_shorter=image_size)
+        images = fn.crop_mirror_normalize(images, device="gpu",
+                                          dtype=types.FLOAT, output_layout="CHW",
+                                          crop=(image_size, image_size),
+                                          mean=[0.485 * 255, 0.456 * 255, 0.406 * 255],
+                                          std=[0.229 * 255, 0.224 * 255, 0.225 * 255])
+        return images, targets.gpu()
+
+    loaders = []
+    for file_list, is_training, n_samples in ((list_files[0], True, len(train_indices)),
+                                              (list_files[1], False, len(val_indices))):
+        pipe = image_pipeline(file_list=file_list, is_training=is_training,
+                              batch_size=batch_size, num_threads=4, device_id=device.index)
+        pipe.build()
+        dali_iter = DALIGenericIterator([pipe], ['data', 'label'], reader_name="Reader",
+                                        last_batch_policy=LastBatchPolicy.PARTIAL)
+        loaders.append(DALILoader(dali_iter, n_samples, batch_size))
+
+    return loaders[0], loaders[1]
+
+def get_webdataset_loaders(batch_size):
+
+    # The 80/20 split and the per-class train balancing happen at pack time
+    # (script/util/Pack_webdataset_shards.py), so shards are consumed as-is here
+    loaders = []
+    for pattern, n_samples, training in ((webdataset_train_shards, webdataset_train_size, True),
+                                         (webdataset_val_shards, webdataset_val_size, False)):
+        ds = wds.WebDataset(pattern, shardshuffle=training)
+        if training:
+            ds = ds.shuffle(1000)
+        # Validation gets the deterministic resize + center-crop, not the training augs
+        if albumentations_available:
+            cpu_transform = apply_albumentations if training else apply_albumentations_val
+            ds = ds.decode('rgb8').to_tuple('jpg', 'cls').map_tuple(cpu_transform, int)
+        else:
+            cpu_transform = transform if training else val_transform
+            ds = ds.decode('pilrgb').to_tuple('jpg', 'cls').map_tuple(cpu_transform, int)
+
+        # Batch inside the pipeline with partial=False and fix the epoch at exactly
+        # n_batches full batches: the DataLoader would otherwise collate per worker,
+        # and the extra partial batches overrun OneCycleLR's planned total_steps
+        n_batches = n_samples // batch_size
+        ds = ds.batched(batch_size, collation_fn=fast_collate, partial=False)
+        loader = wds.WebLoader(ds, batch_size=None, num_workers=min(os.cpu_count(), 16),
+                               pin_memory=True, persistent_workers=True, prefetch_factor=4)
+        loader = loader.repeat().with_epoch(n_batches).with_length(n_batches)
+        loader.dataset = range(n_batches * batch_size)  # for the len(loader.dataset) epoch averages
+        loaders.append(loader)
+
+    return loaders[0], loaders[1]
 
 def get_data_loaders(data_dir, batch_size, num_img_per_class, image_size):
 
-    dataset = ImageFolder(root=data_dir, transform=transform)
+    gpu_decode = data_backend == 'gpu-decode' and torch.cuda.is_available()
+    if gpu_decode:
+        # Workers only read the encoded bytes; nvJPEG decodes them batched on the GPU
+        dataset = JpegImageFolder(root=data_dir, loader=tv_io.read_file)
+        collate_fn = raw_jpeg_collate
+    elif albumentations_available:
+        dataset = CustomImageFolder(root=data_dir, loader=cv2_loader, transform=apply_albumentations)
+        collate_fn = fast_collate
+    else:
+        dataset = CustomImageFolder(root=data_dir, transform=transform)
+        collate_fn = fast_collate
+
+    # Materialize the labels once instead of rebuilding [s[1] for s in dataset.samples] per class
+    labels = np.fromiter((s[1] for s in dataset.samples), dtype=np.int64, count=len(dataset.samples))
 
     # Count the number of images per class
-    class_counts = np.bincount(dataset.targets)  # Directly get counts
+    class_counts = np.bincount(labels)  # Directly get counts
     print("Original images per class:", dict(zip(dataset.classes, class_counts.tolist())))
-    
-    
-    # Sample a specified number of images per class
-    indices = []
-    for class_idx in range(len(dataset.classes)):
-        class_indices = np.where(np.array([s[1] for s in dataset.samples]) == class_idx)[0]
-        if len(class_indices) < num_img_per_class:
-            class_indices = np.random.choice(class_indices, num_img_per_class, replace=True)
-        else:
-            class_indices = np.random.choice(class_indices, num_img_per_class, replace=False)
-        indices.extend(class_indices)
-    
-    # Shuffle and split indices for training and validation
-    train_size = int(0.8 * len(dataset))
-    train_dataset, val_dataset = torch.utils.data.random_split(dataset, [train_size, len(dataset)-train_size])
-
-    train_sampler = SubsetRandomSampler(train_indices)
-    val_sampler = SubsetRandomSampler(val_indices)
 
-    train_loader = DataLoader(dataset, batch_size=batch_size, sampler=train_sampler, num_workers=4)
-    val_loader = DataLoader(dataset, batch_size=batch_size, sampler=val_sampler, num_workers=4)
+    # Split 80/20 without duplicating oversampled indices; class balance comes from the sampler
+    indices = np.random.permutation(len(dataset))
+    split = int(0.8 * len(indices))
+    train_indices, val_indices = indices[:split], indices[split:]
+
+    # Inverse-frequency weights draw fresh balanced mini-batches every epoch
+    sample_weights = (1.0 / class_counts)[labels]
+    num_samples = len(train_indices)  # train_model divides the epoch sums by len(train_loader.dataset)
+    train_sampler = WeightedRandomSampler(torch.as_tensor(sample_weights[train_indices], dtype=torch.double),
+                                          num_samples=num_samples, replacement=True)
+
+    num_workers = min(os.cpu_count(), 16)  # 4 workers cannot feed an EfficientNet-V2-L at 512x512
+    train_loader = DataLoader(Subset(dataset, train_indices), batch_size=batch_size, sampler=train_sampler,
+                              num_workers=num_workers,
+                              pin_memory=True, persistent_workers=True, prefetch_factor=4,
+                              collate_fn=collate_fn)
+    val_loader = DataLoader(Subset(dataset, val_indices), batch_size=batch_size,
+                            num_workers=num_workers,
+                            pin_memory=True, persistent_workers=True, prefetch_factor=4,
+                            collate_fn=collate_fn)
+    if gpu_decode:
+        train_loader = GpuDecodeLoader(train_loader, device, training=True)
+        val_loader = GpuDecodeLoader(val_loader, device, training=False)
+
+    # Print summary of expected images per class (the sampler redraws each epoch)
+    print("Expected number of images per class per epoch:")
+    for class_name in dataset.classes:
+        print(f'Class {class_name}: ~{num_samples // len(dataset.classes)} images')
 
-    # Print summary of number of sampled images per class
-    sampled_class_counts = np.bincount([dataset.samples[idx][1] for idx in indices])
-    print("Number of images per class after sampling:")
-    for class_idx, count in enumerate(sampled_class_counts):
-        print(f'Class {dataset.classes[class_idx]}: {count} images')
-    
     return train_loader, val_loader
 
-def train_model(model, criterion, optimizer, scheduler, train_loader, val_loader, num_epochs, device, writer, checkpoint_path, logger):
-    best_model_wts = copy.deepcopy(model.state_dict())
+class CudaPrefetcher:
+    """Copy batches to the GPU on a side CUDA stream so the H2D transfer of
+    batch N+1 overlaps the compute of batch N (APEX-style prefetch loader)."""
+    def __init__(self, loader, device, training=True):
+        self.loader = loader
+        self.device = device
+        self.training = training
+        self.stream = torch.cuda.Stream(device=device)
+        self.mean = torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor([0.229, 0.224, 0.225], device=device).view(1, 3, 1, 1) * 255
+        self.erase = transforms.RandomErasing(p=0.2, value='random', inplace=True)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        try:
+            inputs, labels = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            inputs = inputs.to(self.device, non_blocking=True)
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+            inputs = inputs.float().sub_(self.mean).div_(self.std)
+            if self.training:
+                for img in inputs:  # per-sample erasing, as a GPU op on the float batch
+                    self.erase(img)
+            labels = labels.to(self.device, non_blocking=True)
+        return inputs, labels
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self._preload(it)
+        while batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            inputs, labels = batch
+            inputs.record_stream(torch.cuda.current_stream())
+            labels.record_stream(torch.cuda.current_stream())
+            batch = self._preload(it)  # enqueue the next copy before the consumer computes
+            yield inputs, labels
+
+def train_model(model, criterion, optimizer, scheduler, scaler, train_loader, val_loader, num_epochs, device, writer, checkpoint_path, logger):
+    best_ckpt_path = None  # best weights live on disk only, no ~500 MB deepcopy in RAM
     best_loss = float('inf')
 
+    # DALI/gpu-decode batches already live on the GPU; the CPU-side loaders need prefetching
+    if torch.cuda.is_available() and not isinstance(train_loader, (DALILoader, GpuDecodeLoader)):
+        train_iter = CudaPrefetcher(train_loader, device)
+        val_iter = CudaPrefetcher(val_loader, device, training=False)
+    else:
+        train_iter, val_iter = train_loader, val_loader
+
+    # GPU-side EMA of the weights; the buffers live next to the model so updates are cheap
+    params = list(model.parameters())
+    ema_params = [p.detach().clone() for p in params]
+    ema_backup = [torch.empty_like(p) for p in params]
+
     for epoch in range(num_epochs):
         logger.info(f'Epoch {epoch}/{num_epochs - 1}')
         logger.info('-' * 10)
         
         # Training phase
         model.train()
-        running_loss = 0.0
-        running_corrects = 0
+        # Accumulate on the GPU; .item() forces a stream sync so it only happens at epoch end
+        running_loss = torch.zeros((), device=device)
+        running_corrects = torch.zeros((), device=device, dtype=torch.long)
 
-        progress_bar = tqdm(train_loader, desc=f"Epoch {epoch}/{num_epochs - 1} Training")
+        progress_bar = tqdm(train_iter, total=len(train_loader), desc=f"Epoch {epoch}/{num_epochs - 1} Training")
+        optimizer.zero_grad(set_to_none=True)  # clear any grads left from an incomplete accumulation window
         for batch_idx, (inputs, labels) in enumerate(progress_bar):
-            inputs = inputs.to(device)
-            labels = labels.to(device)
-
-            optimizer.zero_grad()
-
-            with torch.set_grad_enabled(True):
+            # Mixed precision forward/backward to use the tensor cores
+            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=torch.cuda.is_available()):
                 outputs = model(inputs)
                 loss = criterion(outputs, labels)
-                _, preds = torch.max(outputs, 1)
-                loss.backward()
-                optimizer.step()
-                
+            preds = outputs.argmax(dim=1)  # one kernel, no unused max-values tensor
+            scaler.scale(loss / accum_steps).backward()
+
+            # Only step every accum_steps batches; grads accumulate in between
+            if (batch_idx + 1) % accum_steps == 0:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)  # drop the grads instead of memsetting ~450 MB
                 scheduler.step()
 
-            running_loss += loss.item() * inputs.size(0)
-            running_corrects += torch.sum(preds == labels.data).item()
+                with torch.no_grad():
+                    torch._foreach_mul_(ema_params, ema_decay)
+                    torch._foreach_add_(ema_params, params, alpha=1 - ema_decay)
+
+            batch_corrects = (preds == labels).sum()
+            running_loss += loss.detach() * inputs.size(0)
+            running_corrects += batch_corrects
 
-            # Calculate batch accuracy and error rate
-            batch_loss = loss.item()
-            batch_acc = torch.sum(preds == labels.data).item() / inputs.size(0)
+            # Only pull scalars off the GPU every 20 batches for tqdm/TensorBoard
+            if batch_idx % 20 == 0:
+                batch_loss = loss.item()
+                batch_acc = batch_corrects.item() / inputs.size(0)
 
-            # Update tqdm description with metrics
-            progress_bar.set_postfix({
-                'Loss': f'{batch_loss:.4f}',
-                'Acc': f'{batch_acc:.4f}'
-            })
+                progress_bar.set_postfix({
+                    'Loss': f'{batch_loss:.4f}',
+                    'Acc': f'{batch_acc:.4f}'
+                })
 
-            writer.add_scalar('Training Loss', batch_loss, epoch * len(train_loader) + batch_idx)
-            writer.add_scalar('Learning Rate', scheduler.get_last_lr()[0], epoch * len(train_loader) + batch_idx)
+                writer.add_scalar('Training Loss', batch_loss, epoch * len(train_loader) + batch_idx)
+                writer.add_scalar('Learning Rate', scheduler.get_last_lr()[0], epoch * len(train_loader) + batch_idx)
 
-        epoch_loss = running_loss / len(train_loader.dataset)
-        epoch_acc = running_corrects / len(train_loader.dataset)
+        epoch_loss = running_loss.item() / len(train_loader.dataset)
+        epoch_acc = running_corrects.item() / len(train_loader.dataset)
         
         writer.add_scalar('Epoch Training Loss', epoch_loss, epoch)
         writer.add_scalar('Epoch Training Accuracy', epoch_acc, epoch)
@@ -137,63 +464,92 @@ def train_model(model, criterion, optimizer, scheduler, train_loader, val_loader
         logger.info(f'Train Loss: {epoch_loss:.4f} Acc: {epoch_acc:.4f}')
         print(f'Epoch {epoch}/{num_epochs - 1} - Loss: {epoch_loss:.4f}, Accuracy: {epoch_acc:.4f}')
 
-        # Validation phase
-        model.eval()
-        val_loss = 0.0
-        val_corrects = 0
-
+        # Validation phase — swap the EMA weights in; raw weights are restored afterwards
         with torch.no_grad():
-            for inputs, labels in val_loader:
-                inputs = inputs.to(device)
-                labels = labels.to(device)
+            torch._foreach_copy_(ema_backup, params)
+            torch._foreach_copy_(params, ema_params)
+        model.eval()
+        val_loss = torch.zeros((), device=device)
+        val_corrects = torch.zeros((), device=device, dtype=torch.long)
 
-                outputs = model(inputs)
-                loss = criterion(outputs, labels)
-                _, preds = torch.max(outputs, 1)
+        # inference_mode is cheaper than no_grad (no version counter bookkeeping)
+        with torch.inference_mode():
+            for inputs, labels in val_iter:
+                with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=torch.cuda.is_available()):
+                    outputs = model(inputs)
+                    loss = criterion(outputs, labels)
+                preds = outputs.argmax(dim=1)
 
-                val_loss += loss.item() * inputs.size(0)
-                val_corrects += torch.sum(preds == labels.data).item()
+                val_loss += loss * inputs.size(0)
+                val_corrects += (preds == labels).sum()
 
-        val_loss = val_loss / len(val_loader.dataset)
-        val_acc = val_corrects / len(val_loader.dataset)
+        val_loss = val_loss.item() / len(val_loader.dataset)
+        val_acc = val_corrects.item() / len(val_loader.dataset)
 
         writer.add_scalar('Validation Loss', val_loss, epoch)
         writer.add_scalar('Validation Accuracy', val_acc, epoch)
+        writer.flush()  # one disk write per epoch instead of relying on the default cadence
 
         logger.info(f'Validation Loss: {val_loss:.4f} Acc: {val_acc:.4f}')
         print(f'Epoch {epoch}/{num_epochs - 1} - Validation Loss: {val_loss:.4f}, Validation Accuracy: {val_acc:.4f}')
 
         if val_loss < best_loss:
             best_loss = val_loss
-            best_model_wts = copy.deepcopy(model.state_dict())
             checkpoint_dir = checkpoint_path
             os.makedirs(checkpoint_dir, exist_ok=True)
             model_filename = f'best_model_{epoch}_{best_loss:.2f}.pth'
-            torch.save(model.state_dict(), os.path.join(checkpoint_dir, model_filename))
+            best_ckpt_path = os.path.join(checkpoint_dir, model_filename)
+            torch.save(model.state_dict(), best_ckpt_path)  # checkpoints hold the EMA weights
             logger.info(f"Saved best model checkpoint at epoch {epoch} with validation loss {best_loss:.2f}.")
 
-    model.load_state_dict(best_model_wts)
+        with torch.no_grad():
+            torch._foreach_copy_(params, ema_backup)
+
+    if best_ckpt_path is not None:
+        model.load_state_dict(torch.load(best_ckpt_path, map_location=device))
     return model
 
 
 def main():
-    writer = SummaryWriter(checkpoint_path)
-    device = prepare_device()
-    
+    # Buffer events and flush once per epoch; /mnt/gsdata dislikes many tiny writes
+    writer = SummaryWriter(checkpoint_path, max_queue=1000, flush_secs=120)
+
     data_dir = data_path
-    train_loader, val_loader = get_data_loaders(data_dir, batch_size, num_img_per_class, image_size)
+    if data_backend == 'dali' and dali_available and torch.cuda.is_available():
+        train_loader, val_loader = get_dali_loaders(data_dir, batch_size, num_img_per_class, image_size)
+    elif data_backend == 'webdataset' and webdataset_available:
+        train_loader, val_loader = get_webdataset_loaders(batch_size)
+    else:
+        if data_backend == 'dali':
+            logger.warning("DALI not available, falling back to the torchvision data loader.")
+        elif data_backend == 'webdataset':
+            logger.warning("webdataset not installed, falling back to the torchvision data loader.")
+        train_loader, val_loader = get_data_loaders(data_dir, batch_size, num_img_per_class, image_size)
     
     model = models.efficientnet_v2_l(pretrained=False)
     num_ftrs = model.classifier[1].in_features
     model.classifier[1] = nn.Linear(num_ftrs, num_classes)
-    model = model.to(device)
-
-    criterion = nn.CrossEntropyLoss()
-    optimizer = optim.AdamW(model.parameters(), lr=0.001, weight_decay=1e-4)  # Using AdamW optimizer for better performance
+    model = model.to(device, memory_format=torch.channels_last)  # NHWC for faster cuDNN convolutions
 
-    scheduler = OneCycleLR(optimizer, max_lr=0.01, steps_per_epoch=len(train_loader), epochs=num_epochs)
+    # Compile the model for fused kernels; fall back to eager mode on old PyTorch/GPUs
+    try:
+        model = torch.compile(model, mode="max-autotune")
+    except Exception as e:
+        logger.warning(f"torch.compile not available, running eager: {e}")
 
-    model = train_model(model, criterion, optimizer, scheduler, train_loader, val_loader, num_epochs, device, writer, checkpoint_path, logger)
+    criterion = nn.CrossEntropyLoss()
+    # fused=True updates all ~300 param tensors in one CUDA kernel instead of one launch each;
+    # fall back to the multi-tensor foreach implementation where fused is unsupported
+    try:
+        optimizer = optim.AdamW(model.parameters(), lr=0.001, weight_decay=1e-4, fused=True)
+    except (RuntimeError, TypeError) as e:
+        logger.warning(f"fused AdamW unavailable ({e}), using the foreach implementation")
+        optimizer = optim.AdamW(model.parameters(), lr=0.001, weight_decay=1e-4, foreach=True)
+
+    scheduler = OneCycleLR(optimizer, max_lr=0.01, steps_per_epoch=len(train_loader) // accum_steps, epochs=num_epochs)
+    scaler = torch.cuda.amp.GradScaler(enabled=torch.cuda.is_available())  # No-op on CPU fallback
+
+    model = train_model(model, criterion, optimizer, scheduler, scaler, train_loader, val_loader, num_epochs, device, writer, checkpoint_path, logger)
     
     checkpoint_dir = checkpoint_path
     os.makedirs(checkpoint_dir, exist_ok=True)
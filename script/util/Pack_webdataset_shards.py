@@ -0,0 +1,73 @@
+import os
+import io
+import random
+import tarfile
+from tqdm import tqdm
+
+def collect_samples(data_dir):
+    # List all images in the class subfolders as (path, class index) pairs
+    samples = []
+    classes = sorted(d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+    for class_idx, cls in enumerate(classes):
+        with os.scandir(os.path.join(data_dir, cls)) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.lower().endswith(('.jpg', '.jpeg')):
+                    samples.append((entry.path, class_idx))
+    print("Classes:", dict(enumerate(classes)))
+    return samples
+
+def balance_train_split(samples, num_per_class):
+    # Oversample each class to num_per_class (with replacement where a class is short),
+    # matching the per-class balancing the other training backends apply
+    by_class = {}
+    for sample in samples:
+        by_class.setdefault(sample[1], []).append(sample)
+    balanced = []
+    for label in sorted(by_class):
+        class_samples = by_class[label]
+        if len(class_samples) >= num_per_class:
+            balanced.extend(random.sample(class_samples, num_per_class))
+        else:
+            balanced.extend(random.choices(class_samples, k=num_per_class))
+    random.shuffle(balanced)
+    return balanced
+
+def pack_split(samples, out_dir, split_name, shard_size):
+    # Write webdataset-style shards: one key.jpg + key.cls pair per sample
+    os.makedirs(out_dir, exist_ok=True)
+    shard_idx = 0
+    tar = None
+    for i, (path, label) in enumerate(tqdm(samples, desc=f"Packing {split_name}", unit="img")):
+        if i % shard_size == 0:
+            if tar is not None:
+                tar.close()
+            shard_path = os.path.join(out_dir, f'{split_name}-{shard_idx:06d}.tar')
+            tar = tarfile.open(shard_path, 'w')
+            shard_idx += 1
+        key = f'{i:08d}'
+        tar.add(path, arcname=f'{key}.jpg')
+        cls_bytes = str(label).encode()
+        info = tarfile.TarInfo(f'{key}.cls')
+        info.size = len(cls_bytes)
+        tar.addfile(info, io.BytesIO(cls_bytes))
+    if tar is not None:
+        tar.close()
+    print(f"{split_name}: {len(samples)} samples in {shard_idx} shards")
+
+# Path to the class-subfolder image tree and the shard output folder
+data_path = '/mnt/gsdata/projects/bigplantsens/5_ETH_Zurich_Citizen_Science_Segment/data/'
+out_dir = '/mnt/gsdata/projects/bigplantsens/5_ETH_Zurich_Citizen_Science_Segment/shards'
+
+# Samples per shard and validation fraction (matches the 80/20 split in training)
+shard_size = 1000
+val_fraction = 0.2
+num_img_per_class = 4000  # same target as the training script; train shards get 0.8 * this per class
+
+# Split the unique samples first, then balance only the train split so no
+# oversampled duplicate can end up in the validation shards
+samples = collect_samples(data_path)
+random.shuffle(samples)
+split = int(len(samples) * (1 - val_fraction))
+train_samples = balance_train_split(samples[:split], int(num_img_per_class * (1 - val_fraction)))
+pack_split(train_samples, out_dir, 'train', shard_size)
+pack_split(samples[split:], out_dir, 'val', shard_size)